@@ -1,17 +1,20 @@
+import hashlib
 import json
 import os
-import re
-import subprocess
-import sys
 import tempfile
+import threading
 import uuid
 
-import requests
 from dotenv import load_dotenv
 from flask import Flask, jsonify, request
 from flask_cors import CORS
-from chunker_reworked import hierarchical_chunk_file
-from pdf_parser import extract_document
+from cache import prune_cache
+from chunker_reworked import hierarchical_chunk_pdf
+from downloader import SESSION, file_sha256, save_response
+import runner
+from workers import run_extract
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 app = Flask(__name__)
 CORS(app, origins=os.environ.get("ALLOWED_ORIGINS", "*"))
@@ -19,6 +22,26 @@ CORS(app, origins=os.environ.get("ALLOWED_ORIGINS", "*"))
 load_dotenv()
 CORS(app, resources={r"/*": {"origins": os.getenv("FRONTEND_URL", "*")}})
 
+# Downloaded PDFs are kept here keyed by sha256(url), so re-posting the same
+# document URL costs only a conditional request while it is unchanged.
+DOWNLOAD_CACHE_DIR = os.getenv("DOWNLOAD_CACHE_DIR", os.path.join(BASE_DIR, "data", "download_cache"))
+os.makedirs(DOWNLOAD_CACHE_DIR, exist_ok=True)
+
+# Chunked text keyed by sha256 of the PDF bytes, so the same document skips
+# extraction and chunking whether it arrives by URL or upload.
+CHUNK_CACHE_DIR = os.getenv("CHUNK_CACHE_DIR", os.path.join(BASE_DIR, "data", "chunk_cache"))
+os.makedirs(CHUNK_CACHE_DIR, exist_ok=True)
+
+# Each cache directory is trimmed back to this many bytes, least recently
+# used first, after a new entry is written.
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(2 << 30)))
+
+# Cap how many RAG pipelines a single worker process runs at once, so
+# threaded workers overlap I/O waits without oversubscribing CPU and memory.
+# The default stays below the 8 gthread threads in the Procfile, leaving
+# threads free for health checks and requests waiting on a slot.
+MAX_CONCURRENT_RUNNERS = int(os.getenv("MAX_CONCURRENT_RUNNERS", str(min(4, os.cpu_count() or 1))))
+_runner_slots = threading.BoundedSemaphore(MAX_CONCURRENT_RUNNERS)
 
 @app.route("/health", methods=["GET"])
 def health_check():
@@ -44,6 +67,34 @@ def parse_questions_payload(raw_questions):
     return []
 
 
+def load_download_validators(validators_path):
+    """Return conditional-request headers saved for a cached download, if any."""
+    try:
+        with open(validators_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def save_download_validators(validators_path, validators):
+    """Save a download's ETag/Last-Modified headers for revalidating it later.
+
+    Without either header the copy can't be revalidated, so any old file is
+    removed and the next request downloads the document again.
+    """
+    validators = {name: value for name, value in validators.items() if value}
+    if not validators:
+        try:
+            os.remove(validators_path)
+        except FileNotFoundError:
+            pass
+        return
+    partial_path = f"{validators_path}.{uuid.uuid4().hex}.part"
+    with open(partial_path, "w", encoding="utf-8") as f:
+        json.dump(validators, f)
+    os.replace(partial_path, validators_path)
+
+
 def resolve_input_document(tmpdir):
     uploaded_file = request.files.get("document") or request.files.get("file")
 
@@ -64,22 +115,52 @@ def resolve_input_document(tmpdir):
         input_path = os.path.join(tmpdir, f"upload{file_ext}")
         uploaded_file.save(input_path)
         print(f"[INFO] Uploaded file saved to {input_path}")
-        return input_path, questions, "upload"
+        return input_path, questions, "upload", None
 
     if file_url:
-        file_ext = file_url.split("?")[0].split(".")[-1]
-        input_path = os.path.join(tmpdir, f"doc.{file_ext}")
-        print(f"[INFO] Downloading file to {input_path}")
-        with requests.get(file_url, stream=True, timeout=15) as response:
-            response.raise_for_status()
-            content_type = response.headers.get("Content-Type", "")
-            if not content_type.startswith("application/pdf"):
-                raise ValueError(f"URL did not return a PDF. Content-Type: {content_type}")
-            with open(input_path, "wb") as file_handle:
-                for chunk in response.iter_content(chunk_size=8192):
-                    file_handle.write(chunk)
+        cache_key = hashlib.sha256(file_url.encode("utf-8")).hexdigest()
+        input_path = os.path.join(DOWNLOAD_CACHE_DIR, f"{cache_key}.pdf")
+        validators_path = os.path.join(DOWNLOAD_CACHE_DIR, f"{cache_key}.validators.json")
+        # A cached copy is only reused after the server confirms it is unchanged,
+        # so a document replaced at the same URL is fetched again.
+        headers = load_download_validators(validators_path) if os.path.exists(input_path) else {}
+
+        # Download next to the cache entry and rename it into place, so a
+        # failed or concurrent download never leaves a partial file behind.
+        partial_path = f"{input_path}.{uuid.uuid4().hex}.part"
+        try:
+            with SESSION.get(file_url, headers=headers, stream=True, timeout=(5, 30)) as response:
+                if response.status_code == 304:
+                    try:
+                        # Bumping mtime marks the entry as recently used for prune_cache
+                        os.utime(input_path)
+                    except FileNotFoundError:
+                        # Evicted since the check above; fetch it without validators
+                        return resolve_input_document(tmpdir)
+                    print(f"[INFO] Using cached download {input_path}")
+                    return input_path, questions, "url", None
+
+                response.raise_for_status()
+                content_type = response.headers.get("Content-Type", "")
+                if not content_type.startswith("application/pdf"):
+                    raise ValueError(f"URL did not return a PDF. Content-Type: {content_type}")
+                print(f"[INFO] Downloading file to {input_path}")
+                doc_hash = save_response(response, partial_path)
+                validators = {
+                    "If-None-Match": response.headers.get("ETag"),
+                    "If-Modified-Since": response.headers.get("Last-Modified"),
+                }
+            os.replace(partial_path, input_path)
+        finally:
+            # Already renamed on success; only a failed download leaves it behind
+            try:
+                os.remove(partial_path)
+            except FileNotFoundError:
+                pass
         print("[INFO] File downloaded.")
-        return input_path, questions, "url"
+        save_download_validators(validators_path, validators)
+        prune_cache(DOWNLOAD_CACHE_DIR, CACHE_MAX_BYTES)
+        return input_path, questions, "url", doc_hash
 
     raise ValueError("Provide either a PDF upload or a document URL.")
 
@@ -91,7 +172,7 @@ def process_document():
 
     with tempfile.TemporaryDirectory() as tmpdir:
         try:
-            pdf_path, questions, source_type = resolve_input_document(tmpdir)
+            pdf_path, questions, source_type, doc_hash = resolve_input_document(tmpdir)
         except Exception as e:
             print(f"[ERROR] Failed to prepare input document: {e}")
             return jsonify({"error": f"Failed to prepare input document: {str(e)}"}), 400
@@ -100,52 +181,44 @@ def process_document():
             print("[ERROR] Bad request: missing questions")
             return jsonify({"error": "At least one question is required."}), 400
 
-        txt_path = os.path.join(tmpdir, "document.txt")
-        print("[INFO] Extracting text from document...")
-        text = extract_document(pdf_path)
-        print(f"[INFO] Extracted {len(text)} characters of text.")
-
-        with open(txt_path, "w", encoding="utf-8") as file_handle:
-            file_handle.write(text)
-        print(f"[INFO] Wrote extracted text to {txt_path}")
-
-        chunked_path = os.path.join(tmpdir, "chunked.txt")
-        print("[INFO] Chunking text...")
-        hierarchical_chunk_file(txt_path, chunked_path)
-        print(f"[INFO] Chunked text written to {chunked_path}")
-
-        questions_path = os.path.join(tmpdir, "questions.json")
-        with open(questions_path, "w", encoding="utf-8") as file_handle:
-            json.dump(questions, file_handle)
-        print(f"[INFO] Questions written to {questions_path}")
-
-        print("[INFO] Launching runner.py subprocess...")
-        runner_path = os.path.join(os.path.dirname(__file__), "runner.py")
-        env = os.environ.copy()
-
-        result = subprocess.run(
-            [sys.executable, runner_path, chunked_path, questions_path],
-            capture_output=True,
-            text=True,
-            env=env,
-            cwd=os.path.dirname(__file__),
-        )
-        print("[INFO] runner.py finished.")
-
-        if result.returncode != 0:
-            print("[ERROR] Runner failed (returncode=%d)" % result.returncode)
-            print("[ERROR] STDOUT:", result.stdout)
-            print("[ERROR] STDERR:", result.stderr)
-            details = result.stderr or result.stdout or "no output captured"
-            return jsonify({"error": "Runner failed", "details": details}), 500
-
+        # Fresh downloads are hashed while streaming; only uploads and cached
+        # downloads need a read pass here.
+        doc_hash = doc_hash or file_sha256(pdf_path)
+        chunked_path = os.path.join(CHUNK_CACHE_DIR, f"{doc_hash}.chunked.txt")
         try:
-            json_text = re.search(r"(\{[\s\S]*\})", result.stdout).group(1)
-            runner_result = json.loads(json_text)
-            print("[INFO] Successfully parsed runner output JSON.")
-        except Exception as e:
-            print("[WARNING] Could not parse runner output JSON:", e)
-            runner_result = {"raw_output": result.stdout}
+            os.utime(chunked_path)
+            cached = True
+        except FileNotFoundError:
+            cached = False
+        if cached:
+            print(f"[INFO] Using cached chunks {chunked_path}")
+        else:
+            partial_path = f"{chunked_path}.{uuid.uuid4().hex}.part"
+            print("[INFO] Extracting and chunking document...")
+            # One worker call: the text goes straight from extraction to the
+            # chunker and never touches disk or crosses the process boundary
+            try:
+                num_chars = run_extract(hierarchical_chunk_pdf, pdf_path, partial_path)
+                print(f"[INFO] Extracted {num_chars} characters of text.")
+                os.replace(partial_path, chunked_path)
+            finally:
+                # Already renamed on success; prune_cache skips .part files,
+                # so a failed extraction must clean up its own
+                try:
+                    os.remove(partial_path)
+                except FileNotFoundError:
+                    pass
+            print(f"[INFO] Chunked text written to {chunked_path}")
+            prune_cache(CHUNK_CACHE_DIR, CACHE_MAX_BYTES)
+
+        print("[INFO] Running RAG pipeline...")
+        with _runner_slots:
+            try:
+                runner_result = runner.run(chunked_path, questions)
+            except Exception as e:
+                print(f"[ERROR] Runner failed: {e}")
+                return jsonify({"error": "Runner failed", "details": str(e)}), 500
+        print("[INFO] RAG pipeline finished.")
 
         print(f"[INFO] Session complete: {session_id}")
 
@@ -164,4 +237,5 @@ def health():
     return jsonify({'status': 'ok'}), 200
 
 if __name__ == '__main__':
-    app.run(debug=True, port=5000)
+    # Development server only; production runs under gunicorn (see Procfile).
+    app.run(debug=os.getenv("FLASK_DEBUG") == "1", port=5000, threaded=True)
@@ -1,11 +1,10 @@
 import os
 import tempfile
 import uuid
-import requests
+import shutil
+import threading
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import subprocess
-import json
 import time
 import signal
 import sys
@@ -13,11 +12,14 @@ from dotenv import load_dotenv
 
 # Load environment variables at the beginning
 load_dotenv(override=True)
-from pdf_parser import extract_document
-from chunker_reworked import hierarchical_chunk_file
+from chunker_reworked import hierarchical_chunk_pdf
+from downloader import COPY_BUFFER_SIZE, SESSION, save_response
+from workers import run_extract, shutdown_extract_pool
+import runner
 from thread_manager import (
     create_thread, get_thread_state, reset_thread, 
-    process_message, memory, release_thread_lock
+    process_message, memory, release_thread_lock, get_reply_for_key,
+    add_message, get_conversation_context, extract_entities_and_facts
 )
 
 app = Flask(__name__)
@@ -26,6 +28,49 @@ CORS(app, origins=os.environ.get("ALLOWED_ORIGINS", "*"))
 # Store document paths for reuse
 document_paths = {}
 
+# Prepared documents keyed by sha256 of the PDF bytes, so a document that is
+# already ingested skips extraction, chunking and embedding for new threads
+INGEST_CACHE_SIZE = int(os.getenv("INGEST_CACHE_SIZE", "32"))
+ingested_documents = {}
+ingested_documents_lock = threading.Lock()
+
+def lookup_ingested_document(doc_hash):
+    """Return a prepared document, marking it as most recently used"""
+    with ingested_documents_lock:
+        entry = ingested_documents.pop(doc_hash, None)
+        if entry is not None:
+            ingested_documents[doc_hash] = entry
+        return entry
+
+def remember_ingested_document(doc_hash, entry):
+    """Record a prepared document, dropping the least recently used once the cache is full"""
+    with ingested_documents_lock:
+        ingested_documents.pop(doc_hash, None)
+        ingested_documents[doc_hash] = entry
+        # Dicts keep insertion order and hits re-insert, so the least
+        # recently used entries are dropped first
+        while len(ingested_documents) > INGEST_CACHE_SIZE:
+            del ingested_documents[next(iter(ingested_documents))]
+
+def get_search_index(doc_paths):
+    """Return the thread's Astra index, storing its chunks there on first use"""
+    with doc_paths['index_lock']:
+        if 'search_index' not in doc_paths:
+            # Threads created before a failed preparation build their index on first use
+            if 'rag_handle' not in doc_paths:
+                doc_paths['rag_handle'] = runner.build_index(doc_paths['chunked_path'])
+            doc_paths['search_index'] = runner.store_index(doc_paths['rag_handle'])
+        return doc_paths['search_index']
+
+def release_thread_documents(thread_id):
+    """Forget a deleted thread's documents and remove its chunks from Astra"""
+    doc_paths = document_paths.pop(thread_id, None)
+    if doc_paths and 'search_index' in doc_paths:
+        runner.release_index(doc_paths['search_index'])
+
+# Expired threads release their Astra index along with their memory
+memory.delete_callbacks.append(release_thread_documents)
+
 @app.route('/threads', methods=['POST'])
 def create_thread_endpoint():
     """Create a new thread for a document"""
@@ -56,28 +101,23 @@ def create_thread_endpoint():
         pdf_path = os.path.join(session_dir, f'doc.{file_ext}')
         print(f"[INFO] Downloading file to {pdf_path}")
         
-        with requests.get(file_url, stream=True) as r:
+        with SESSION.get(file_url, stream=True, timeout=(5, 30)) as r:
             r.raise_for_status()
-            with open(pdf_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
+            doc_hash = save_response(r, pdf_path)
         print("[INFO] File downloaded.")
         
-        # Extract text
-        txt_path = os.path.join(session_dir, 'document.txt')
-        print("[INFO] Extracting text from document...")
-        text = extract_document(pdf_path)
-        print(f"[INFO] Extracted {len(text)} characters of text.")
-        
-        with open(txt_path, 'w', encoding='utf-8') as f:
-            f.write(text)
-        print(f"[INFO] Wrote extracted text to {txt_path}")
-        
-        # Chunk text
-        chunked_path = os.path.join(session_dir, 'chunked.txt')
-        print("[INFO] Chunking text...")
-        hierarchical_chunk_file(txt_path, chunked_path)
-        print(f"[INFO] Chunked text written to {chunked_path}")
+        ingested = lookup_ingested_document(doc_hash)
+        if ingested:
+            chunked_path = ingested['chunked_path']
+            num_chars = ingested['characters']
+            print(f"[INFO] Reusing prepared document {chunked_path}")
+        else:
+            # Extract and chunk text
+            chunked_path = os.path.join(session_dir, 'chunked.txt')
+            print("[INFO] Extracting and chunking document...")
+            num_chars = run_extract(hierarchical_chunk_pdf, pdf_path, chunked_path)
+            print(f"[INFO] Extracted {num_chars} characters of text.")
+            print(f"[INFO] Chunked text written to {chunked_path}")
         
         # Create a new thread
         thread_id = create_thread(
@@ -89,16 +129,24 @@ def create_thread_endpoint():
         # Store document paths for future use
         document_paths[thread_id] = {
             'pdf_path': pdf_path,
-            'txt_path': txt_path,
             'chunked_path': chunked_path,
             'file_url': file_url,
             'session_id': session_id,
-            'dir_path': session_dir
+            'dir_path': session_dir,
+            'index_lock': threading.Lock()
         }
         
-        # Prepare chunked file for future RAG queries
-        # Run runner.py to set up embeddings and index
-        prepare_embeddings_for_thread(thread_id)
+        if ingested:
+            document_paths[thread_id]['rag_handle'] = ingested['rag_handle']
+        else:
+            # Prepare chunked file for future RAG queries
+            prepare_embeddings_for_thread(thread_id)
+            if 'rag_handle' in document_paths[thread_id]:
+                remember_ingested_document(doc_hash, {
+                    'chunked_path': chunked_path,
+                    'characters': num_chars,
+                    'rag_handle': document_paths[thread_id]['rag_handle']
+                })
         
         print(f"[INFO] Thread created: {thread_id}")
         
@@ -108,7 +156,7 @@ def create_thread_endpoint():
             'status': 'created',
             'document_info': {
                 'url': file_url,
-                'characters': len(text),
+                'characters': num_chars,
             }
         })
             
@@ -185,36 +233,12 @@ def prepare_embeddings_for_thread(thread_id):
         print(f"[ERROR] Chunked file not found: {chunked_path}")
         return
     
-    # Create temporary questions file for initial embedding to avoid cluttering the session directory
-    with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.json') as temp_file:
-        json.dump(["Initialize embeddings"], temp_file)
-        questions_path = temp_file.name
-        print(f"[INFO] Created temporary questions file at: {questions_path}")
-    
-    # Track this file for cleanup
-    doc_paths['temp_init_file'] = questions_path
-    
-    # Run runner.py to prepare embeddings
+    # Parse and embed once; every message on this thread reuses the result
     print("[INFO] Preparing embeddings for document...")
-    
-    # Pass environment variables to the subprocess
-    env = os.environ.copy()
-    
-    result = subprocess.run(
-        ['python', 'runner.py', chunked_path, questions_path],
-        capture_output=True, text=True,
-        env=env  # Pass the environment variables
-    )
-    
-    # Clean up temporary file
     try:
-        os.unlink(questions_path)
-        print(f"[INFO] Removed temporary questions file: {questions_path}")
+        doc_paths['rag_handle'] = runner.build_index(chunked_path)
     except Exception as e:
-        print(f"[WARNING] Failed to remove temporary file: {str(e)}")
-    
-    if result.returncode != 0:
-        print("[ERROR] Embedding preparation failed:\n", result.stderr)
+        print(f"[ERROR] Embedding preparation failed: {str(e)}")
         return
     
     print("[INFO] Embeddings prepared successfully")
@@ -222,48 +246,28 @@ def prepare_embeddings_for_thread(thread_id):
 def process_message_with_rag(thread_id, question, idempotency_key, memory_version=None, parent_message_id=None):
     """Process a message with RAG integration"""
     # Check for idempotency
-    if thread_id in memory.messages:
-        for msg in memory.messages[thread_id]:
-            if msg.get("idempotency_key") == idempotency_key and msg["role"] == "user":
-                # Find the assistant response that followed
-                for reply in memory.messages[thread_id]:
-                    if reply.get("parent_id") == msg["message_id"] and reply["role"] == "assistant":
-                        return {
-                            "thread_id": thread_id,
-                            "message_id": reply["message_id"],
-                            "answer": reply["content"],
-                            "status": "cached"
-                        }
+    reply = get_reply_for_key(thread_id, idempotency_key)
+    if reply:
+        return {
+            "thread_id": thread_id,
+            "message_id": reply["message_id"],
+            "answer": reply["content"],
+            "status": "cached"
+        }
     
     # Get document paths
     if thread_id not in document_paths:
         return {'error': 'Document not found for this thread'}
     
     doc_paths = document_paths[thread_id]
-    
-    # Check if we're using persistent storage or temporary files
-    if 'dir_path' in doc_paths:
-        # Using persistent storage
-        session_dir = doc_paths['dir_path']
-        chunked_path = os.path.join(session_dir, 'chunked.txt')
-        
-        # Make sure session directory exists
-        if not os.path.exists(session_dir):
-            os.makedirs(session_dir, exist_ok=True)
-    else:
-        # Using older temporary storage approach
-        chunked_path = doc_paths['chunked_path']
-    
-    # Verify the chunked path exists
-    if not os.path.exists(chunked_path):
-        print(f"[ERROR] Chunked document not found at: {chunked_path}")
-        return {'error': f'Chunked document not found. The file may have been deleted.'}
+    # May live in another thread's directory when the document was reused.
+    # Only read if the thread has no index yet, and build_index reports a
+    # missing file itself, so there is no per-message stat here.
+    chunked_path = doc_paths['chunked_path']
     
     print(f"[INFO] Using chunked document at: {chunked_path}")
     
     # Add user message to thread
-    from thread_manager import add_message, get_conversation_context, extract_entities_and_facts
-    
     user_msg = add_message(
         thread_id=thread_id,
         role="user",
@@ -279,19 +283,6 @@ def process_message_with_rag(thread_id, question, idempotency_key, memory_versio
     # Get conversation context
     context = get_conversation_context(thread_id, question)
     
-    # Prepare for RAG query
-    # Check if we have a persistent directory to use
-    if 'dir_path' in doc_paths:
-        # Use session directory for question file
-        questions_path = os.path.join(doc_paths['dir_path'], f'question_{uuid.uuid4()}.json')
-    else:
-        # Create a temporary directory for the question file
-        import tempfile
-        temp_dir = tempfile.mkdtemp()
-        questions_path = os.path.join(temp_dir, f'question_{uuid.uuid4()}.json')
-    
-    print(f"[INFO] Creating question file at: {questions_path}")
-    
     # Enhance question with conversation context
     enhanced_question = question
     if context["conversation_history"]:
@@ -301,91 +292,53 @@ def process_message_with_rag(thread_id, question, idempotency_key, memory_versio
             entities_str = ", ".join([f"{k}: {v}" for k, v in entities.items()])
             enhanced_question = f"{question}\n\nContext: {entities_str}"
     
-    # Write question to file
-    try:
-        with open(questions_path, 'w', encoding='utf-8') as f:
-            json.dump([enhanced_question], f)
-        print(f"[INFO] Successfully wrote question to file: {questions_path}")
-    except Exception as e:
-        print(f"[ERROR] Failed to write question file: {str(e)}")
-        raise
-    
-    # Run runner.py to get answer
     print(f"[INFO] Processing question: {question[:100]}...")
     print(f"[INFO] Chunked path: {chunked_path}")
-    print(f"[INFO] Questions path: {questions_path}")
-    
-    # Verify files exist
-    if not os.path.exists(chunked_path):
-        print(f"[ERROR] Chunked file not found: {chunked_path}")
-        return {'error': 'Chunked file not found'}
     
-    if not os.path.exists(questions_path):
-        print(f"[ERROR] Questions file not found: {questions_path}")
-        return {'error': 'Questions file not found'}
-    
-    # Pass environment variables to the subprocess
-    env = os.environ.copy()
-    
-    # Run with full error output
-    try:
-        result = subprocess.run(
-            ['python', 'runner.py', chunked_path, questions_path],
-            capture_output=True, text=True,
-            env=env,  # Pass the environment variables
-            check=False  # Don't raise exception on non-zero exit
-        )
-        
-        # Print any stderr output for debugging
-        if result.stderr:
-            print(f"[WARN] Runner stderr output: {result.stderr}")
-    except Exception as e:
-        print(f"[ERROR] Failed to run subprocess: {str(e)}")
-        
-        # Clean up question file before returning error
+    # Repeats of a question (with the same conversation context) reuse the earlier answer
+    answer_cache = doc_paths.setdefault('answer_cache', {})
+    # Paraphrase matches are only valid under the same context, so the semantic
+    # cache is partitioned by the context suffix added to the question
+    context_suffix = enhanced_question[len(question):]
+    semantic_cache = doc_paths.setdefault('semantic_cache', {}).setdefault(context_suffix, [])  # (question embedding, answer)
+    cache_key = " ".join(enhanced_question.lower().split())
+    answer = answer_cache.get(cache_key)
+    
+    if answer is not None:
+        print("[INFO] Using cached answer")
+    else:
         try:
-            os.unlink(questions_path)
-            print(f"[INFO] Removed question file: {questions_path}")
-        except Exception as cleanup_error:
-            print(f"[WARNING] Failed to remove question file: {str(cleanup_error)}")
-            
-        return {'error': f'Failed to run subprocess: {str(e)}'}
-    
-    # Clean up question file after use
-    try:
-        os.unlink(questions_path)
-        print(f"[INFO] Removed question file: {questions_path}")
-    except Exception as e:
-        print(f"[WARNING] Failed to remove question file: {str(e)}")
-    
-    if result.returncode != 0:
-        print("[ERROR] RAG query failed:\n", result.stderr)
-        # Add error message
-        add_message(
-            thread_id=thread_id,
-            role="assistant",
-            content="Sorry, I couldn't process your question. Please try again.",
-            idempotency_key=f"reply-{idempotency_key}",
-            parent_message_id=user_msg["message_id"]
-        )
-        return {'error': 'RAG query failed', 'details': result.stderr}
-    
-    # Parse JSON from runner.py output
-    import re
-    try:
-        json_text = re.search(r'(\{[\s\S]*\})', result.stdout).group(1)
-        runner_result = json.loads(json_text)
-        print("[INFO] Successfully parsed runner output JSON.")
+            # Paraphrases of an earlier question reuse its answer too. Embed the
+            # raw question: the shared context suffix would dominate the vector
+            # and make unrelated questions in this thread look alike.
+            question_embedding = runner.batch_embed_questions([question])[0]
+            answer = runner.find_similar_answer(semantic_cache, question_embedding)
+            if answer is None:
+                # Chunks are stored in Astra once per thread, not once per message
+                runner_result = runner.answer_questions(get_search_index(doc_paths), [enhanced_question])
+        except Exception as e:
+            print(f"[ERROR] RAG query failed: {str(e)}")
+            # Add error message
+            add_message(
+                thread_id=thread_id,
+                role="assistant",
+                content="Sorry, I couldn't process your question. Please try again.",
+                idempotency_key=f"reply-{idempotency_key}",
+                parent_message_id=user_msg["message_id"]
+            )
+            return {'error': 'RAG query failed', 'details': str(e)}
         
         # Extract answer from runner result
-        if isinstance(runner_result, dict) and "answers" in runner_result and runner_result["answers"]:
+        if answer is not None:
+            print("[INFO] Using answer cached for a similar question")
+        elif runner_result["answers"]:
             answer = runner_result["answers"][0]
+            # Per-question failures come back as an answer string; don't cache those
+            if not answer.startswith("Error processing question"):
+                answer_cache[cache_key] = answer
+                semantic_cache.append((question_embedding, answer))
         else:
             answer = "No clear answer found in the document for this question."
-        
-    except Exception as e:
-        print("[WARNING] Could not parse runner output JSON:", e)
-        answer = "There was an issue processing your question."
     
     # Add assistant message
     assistant_msg = add_message(
@@ -440,61 +393,29 @@ def process_document():
         file_ext = file_url.split('?')[0].split('.')[-1]
         pdf_path = os.path.join(tmpdir, f'doc.{file_ext}')
         print(f"[INFO] Downloading file to {pdf_path}")
-        with requests.get(file_url, stream=True) as r:
+        with SESSION.get(file_url, stream=True, timeout=(5, 30)) as r:
             r.raise_for_status()
+            r.raw.decode_content = True
             with open(pdf_path, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
+                shutil.copyfileobj(r.raw, f, length=COPY_BUFFER_SIZE)
         print("[INFO] File downloaded.")
 
-        # Extract text
-        txt_path = os.path.join(tmpdir, 'document.txt')
-        print("[INFO] Extracting text from document...")
-        text = extract_document(pdf_path)
-        print(f"[INFO] Extracted {len(text)} characters of text.")
-
-        with open(txt_path, 'w', encoding='utf-8') as f:
-            f.write(text)
-        print(f"[INFO] Wrote extracted text to {txt_path}")
-
-        # Chunk text
+        # Extract and chunk text
         chunked_path = os.path.join(tmpdir, 'chunked.txt')
-        print("[INFO] Chunking text...")
-        hierarchical_chunk_file(txt_path, chunked_path)
+        print("[INFO] Extracting and chunking document...")
+        num_chars = run_extract(hierarchical_chunk_pdf, pdf_path, chunked_path)
+        print(f"[INFO] Extracted {num_chars} characters of text.")
         print(f"[INFO] Chunked text written to {chunked_path}")
 
-        # Write questions to a JSON file
-        questions_path = os.path.join(tmpdir, 'questions.json')
-        with open(questions_path, 'w', encoding='utf-8') as f:
-            json.dump(questions, f)
-        print(f"[INFO] Questions written to {questions_path}")
-
-        # Run runner.py with chunked file and questions
-        print("[INFO] Launching runner.py subprocess...")
-        
-        # Pass environment variables to the subprocess
-        env = os.environ.copy()
-        
-        result = subprocess.run(
-            ['python', 'runner.py', chunked_path, questions_path],
-            capture_output=True, text=True, 
-            env=env  # Pass the environment variables
-        )
-        print("[INFO] runner.py finished.")
-
-        if result.returncode != 0:
-            print("[ERROR] Runner failed:\n", result.stderr)
-            return jsonify({'error': 'Runner failed', 'details': result.stderr}), 500
-
-        # Parse JSON from runner.py output
-        import re
+        # Answer in-process: the runner's clients and models are already loaded
+        print("[INFO] Running questions through runner...")
         try:
-            json_text = re.search(r'(\{[\s\S]*\})', result.stdout).group(1)
-            runner_result = json.loads(json_text)
-            print("[INFO] Successfully parsed runner output JSON.")
+            runner_result = runner.run(chunked_path, questions)
         except Exception as e:
-            print("[WARNING] Could not parse runner output JSON:", e)
-            runner_result = {'raw_output': result.stdout}
+            print("[ERROR] Runner failed:", e)
+            reset_thread(temp_thread_id)
+            return jsonify({'error': 'Runner failed', 'details': str(e)}), 500
+        print("[INFO] runner finished.")
 
         print(f"[INFO] Session complete: {session_id}")
         
@@ -531,39 +452,16 @@ def shutdown_server():
     """Properly shutdown the server and all child processes"""
     print("\n[INFO] Shutting down server...")
     
-    # Get all Python processes
+    # The extraction pool's workers are the only child processes we start
     try:
-        if os.name == 'nt':  # Windows
-            # Find all Python processes
-            process_info = subprocess.check_output('tasklist /FI "IMAGENAME eq python.exe" /FO CSV', shell=True).decode()
-            lines = process_info.strip().split('\n')[1:]  # Skip header
-            
-            # Extract PIDs
-            import re
-            pids = []
-            for line in lines:
-                match = re.search(r'"python\.exe","(\d+)"', line)
-                if match:
-                    pids.append(int(match.group(1)))
-            
-            current_pid = os.getpid()
-            print(f"[INFO] Current process: {current_pid}")
-            
-            # Kill all Python processes except current one
-            for pid in pids:
-                if pid != current_pid:
-                    print(f"[INFO] Terminating Python process: {pid}")
-                    try:
-                        subprocess.call(f'taskkill /F /PID {pid}', shell=True)
-                    except Exception as e:
-                        print(f"[ERROR] Failed to kill process {pid}: {str(e)}")
-        else:  # Unix/Linux/Mac
-            # For Unix systems, we could use pkill/killall but we'll keep it simple
-            print("[INFO] On Unix systems, please ensure all processes are terminated manually if needed")
-    
+        shutdown_extract_pool()
     except Exception as e:
         print(f"[ERROR] Error while shutting down processes: {str(e)}")
     
+    # Remove live threads' chunks from Astra
+    for thread_id in list(document_paths):
+        release_thread_documents(thread_id)
+    
     # Exit the main process
     print("[INFO] Server shutdown complete")
     sys.exit(0)
@@ -573,23 +471,24 @@ def signal_handler(sig, frame):
     print("\n[INFO] Ctrl+C detected, initiating graceful shutdown...")
     shutdown_server()
 
-# Register the signal handler
-signal.signal(signal.SIGINT, signal_handler)
-signal.signal(signal.SIGTERM, signal_handler)
-
 @app.route('/health', methods=['GET'])
 def health():
     return jsonify({'status': 'ok'}), 200
 
 if __name__ == '__main__':
+    # Register the signal handler only for the dev server; under gunicorn the
+    # worker's own handlers must stay in place for graceful drain and reload
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    
     print("[INFO] Starting server... Press Ctrl+C to shut down")
     print("[INFO] This server is configured to terminate all related Python processes on shutdown")
     
     # Clean up any existing empty_questions.json files at startup
     cleanup_empty_questions_files()
     
-    # In production, we would use threaded=True, but for development with clean shutdown:
+    # threaded=True lets a slow RAG query overlap with other requests. For clean shutdown:
     # 1. use_reloader=False prevents the reloader from creating a child process
     # 2. debug=False prevents Flask from launching multiple processes
     # This setup ensures clean shutdown with Ctrl+C, but you won't get auto-reload on code changes
-    app.run(debug=False, port=5000, use_reloader=False)
+    app.run(debug=False, port=5000, use_reloader=False, threaded=True)
@@ -0,0 +1,34 @@
+"""
+Disk Cache Helpers for DocuSage
+Size-capped, least-recently-used trimming for the on-disk caches
+"""
+
+import os
+
+
+def prune_cache(cache_dir: str, max_bytes: int):
+    """Delete the least recently used files in cache_dir until it fits in max_bytes.
+
+    Cache hits bump the file's mtime, so mtime order is LRU order. Files
+    in use by an in-flight request are the newest and are removed last.
+    """
+    entries = []
+    total = 0
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if entry.is_file() and not entry.name.endswith(".part"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+    if total <= max_bytes:
+        return
+
+    for _, size, path in sorted(entries):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        print(f"[INFO] Evicted cache entry {path}")
+        if total <= max_bytes:
+            break
@@ -2,6 +2,8 @@ import re
 from collections import Counter
 from typing import List, Tuple, Dict, Set
 
+from pdf_parser import extract_document
+
 def clean_text(text: str) -> str:
     """Clean and normalize text."""
     # Remove repeated headers/footers by frequency analysis
@@ -375,6 +377,42 @@ def get_overlap_content(lines: List[str], target_tokens: int) -> str:
     
     return overlap_text
 
+def hierarchical_chunk_text(text: str, output_txt_path: str, max_tokens: int = 500, overlap_tokens: int = 75, source: str = "text") -> List[str]:
+    """Hierarchically chunk text already in memory and write the chunks to a file."""
+    # Step 1: Clean text while preserving structure
+    cleaned_text = clean_text(text)
+    
+    # Step 2: Build hierarchical structure
+    root_node = build_hierarchical_structure(cleaned_text)
+    
+    # Step 3: Create semantic chunks that preserve hierarchy
+    chunks = create_semantic_chunks(root_node, max_tokens=max_tokens, overlap_tokens=overlap_tokens)
+    
+    # Step 4: Write output
+    with open(output_txt_path, 'w', encoding='utf-8') as f:
+        f.write('\n\n'.join(chunks))
+    
+    print(f"Successfully created {len(chunks)} chunks from {source}")
+    print(f"Output written to {output_txt_path}")
+    
+    # Print some stats
+    total_words = len(cleaned_text.split())
+    avg_chunk_size = total_words / len(chunks) if chunks else 0
+    print(f"Total words: {total_words}, Average chunk size: {avg_chunk_size:.0f} words")
+    
+    return chunks
+
+def hierarchical_chunk_pdf(pdf_path: str, output_txt_path: str, max_tokens: int = 500, overlap_tokens: int = 75) -> int:
+    """Extract a PDF and chunk its text in one pass, returning the extracted character count.
+
+    The text goes straight from the extractor to the chunker without an
+    intermediate .txt file.
+    """
+    text = extract_document(pdf_path)
+    print(f"Extracted {len(text)} characters from {pdf_path}")
+    hierarchical_chunk_text(text, output_txt_path, max_tokens, overlap_tokens, source=pdf_path)
+    return len(text)
+
 def hierarchical_chunk_file(input_txt_path: str, output_txt_path: str, max_tokens: int = 500, overlap_tokens: int = 75):
     """Main function to hierarchically chunk a text file."""
     try:
@@ -382,26 +420,7 @@ def hierarchical_chunk_file(input_txt_path: str, output_txt_path: str, max_token
         with open(input_txt_path, 'r', encoding='utf-8') as f:
             text = f.read()
         
-        # Step 1: Clean text while preserving structure
-        cleaned_text = clean_text(text)
-        
-        # Step 2: Build hierarchical structure
-        root_node = build_hierarchical_structure(cleaned_text)
-        
-        # Step 3: Create semantic chunks that preserve hierarchy
-        chunks = create_semantic_chunks(root_node, max_tokens=max_tokens, overlap_tokens=overlap_tokens)
-        
-        # Step 4: Write output
-        with open(output_txt_path, 'w', encoding='utf-8') as f:
-            f.write('\n\n'.join(chunks))
-        
-        print(f"Successfully created {len(chunks)} chunks from {input_txt_path}")
-        print(f"Output written to {output_txt_path}")
-        
-        # Print some stats
-        total_words = len(cleaned_text.split())
-        avg_chunk_size = total_words / len(chunks) if chunks else 0
-        print(f"Total words: {total_words}, Average chunk size: {avg_chunk_size:.0f} words")
+        hierarchical_chunk_text(text, output_txt_path, max_tokens, overlap_tokens, source=input_txt_path)
         
     except FileNotFoundError:
         print(f"Error: Input file '{input_txt_path}' not found.")
@@ -0,0 +1,107 @@
+"""
+Document Downloader for DocuSage
+Shared HTTP session and streaming helpers for fetching documents by URL
+"""
+
+import hashlib
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+load_dotenv()
+
+# Downloads larger than this are fetched as parallel Range requests when the
+# server advertises byte-range support.
+RANGE_DOWNLOAD_THRESHOLD = int(os.getenv("RANGE_DOWNLOAD_THRESHOLD", str(50 << 20)))
+RANGE_DOWNLOAD_SEGMENTS = int(os.getenv("RANGE_DOWNLOAD_SEGMENTS", "8"))
+COPY_BUFFER_SIZE = 1 << 20  # 1 MiB
+
+# Shared HTTP session so repeat downloads from the same host reuse
+# keep-alive connections instead of paying a fresh TCP/TLS handshake.
+SESSION = requests.Session()
+SESSION.headers.update({"User-Agent": "DocuSage/1.0"})
+_adapter = HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=50,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+
+
+class _HashingWriter:
+    """File wrapper that feeds every written block to a hasher."""
+
+    def __init__(self, file_handle, hasher):
+        self.file_handle = file_handle
+        self.hasher = hasher
+
+    def write(self, data):
+        self.hasher.update(data)
+        return self.file_handle.write(data)
+
+
+def file_sha256(path: str) -> str:
+    """Return the hex SHA-256 digest of a file on disk."""
+    with open(path, "rb") as file_handle:
+        # Reads and hashes in C, releasing the GIL, without a Python-level loop
+        return hashlib.file_digest(file_handle, "sha256").hexdigest()
+
+
+def download_range(url: str, path: str, start: int, end: int):
+    """Fetch bytes start..end (inclusive) of url into the same offsets of path."""
+    with SESSION.get(url, headers={"Range": f"bytes={start}-{end}"}, stream=True, timeout=(5, 30)) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise ValueError(f"Server ignored Range request (status {response.status_code})")
+        with open(path, "r+b") as file_handle:
+            file_handle.seek(start)
+            shutil.copyfileobj(response.raw, file_handle, length=COPY_BUFFER_SIZE)
+            written = file_handle.tell() - start
+    if written != end - start + 1:
+        raise ValueError(f"Incomplete range {start}-{end}: got {written} bytes")
+
+
+def download_in_ranges(url: str, path: str, size: int, segments: int = RANGE_DOWNLOAD_SEGMENTS):
+    """Fetch a large file as parallel byte ranges written at their offsets."""
+    with open(path, "wb") as file_handle:
+        file_handle.truncate(size)
+
+    segment = -(-size // segments)
+    ranges = [(start, min(start + segment, size) - 1) for start in range(0, size, segment)]
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        futures = [executor.submit(download_range, url, path, start, end) for start, end in ranges]
+        for future in futures:
+            future.result()
+
+
+def save_response(response: requests.Response, path: str) -> str:
+    """Write a streamed response body to path and return its SHA-256 digest.
+
+    Large bodies from servers that accept byte ranges are re-fetched as
+    parallel ranges; everything else is copied in C with a 1 MiB buffer and
+    hashed on the way through, so the file is never read back.
+    """
+    content_length = int(response.headers.get("Content-Length") or 0)
+    use_ranges = (
+        content_length > RANGE_DOWNLOAD_THRESHOLD
+        and response.headers.get("Accept-Ranges") == "bytes"
+        and not response.headers.get("Content-Encoding")
+    )
+    if use_ranges:
+        response.close()
+        print(f"[INFO] Large file ({content_length} bytes), downloading in {RANGE_DOWNLOAD_SEGMENTS} ranges")
+        download_in_ranges(response.url, path, content_length)
+        # Ranges land out of order, so hash the assembled file instead
+        return file_sha256(path)
+
+    hasher = hashlib.sha256()
+    response.raw.decode_content = True
+    with open(path, "wb") as file_handle:
+        shutil.copyfileobj(response.raw, _HashingWriter(file_handle, hasher), length=COPY_BUFFER_SIZE)
+    return hasher.hexdigest()
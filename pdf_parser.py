@@ -1,11 +1,14 @@
 import argparse
 import math
+import multiprocessing
 import os
 import re
 import shutil
 import subprocess
 import sys
 from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
 from typing import List, Tuple, Optional, Dict, Set
 
 
@@ -24,15 +27,25 @@ _LIG_RE = re.compile("|".join(map(re.escape, LIG_MAP.keys())))
 def normalize(s: str) -> str:
     if not s:
         return ""
-    s = _LIG_RE.sub(lambda m: LIG_MAP[m.group(0)], s)
+    # Every LIG_MAP key is non-ASCII, and isascii() is O(1) on str, so
+    # plain-ASCII lines (the common case) skip the regex scan entirely
+    if not s.isascii():
+        s = _LIG_RE.sub(lambda m: LIG_MAP[m.group(0)], s)
     return s.replace("\t", " ").strip()
 
 
+# Three C-level passes beat one alternation here: a combined pattern needs a
+# Python callback per match and loses the engine's literal-prefix scanning.
+_HYPHEN_BREAK_RE = re.compile(r"(\w)-\n([a-z])")
+_TRAILING_WS_RE = re.compile(r"[ \t]+\n")
+_BLANK_LINES_RE = re.compile(r"\n{3,}")
+
+
 def dehyphenate(text: str) -> str:
     # join hyphenated line-breaks like "bene-\nfit" -> "benefit"
-    text = re.sub(r"(\w)-\n([a-z])", r"\1\2", text)
-    text = re.sub(r"[ \t]+\n", "\n", text)
-    text = re.sub(r"\n{3,}", "\n\n", text)
+    text = _HYPHEN_BREAK_RE.sub(r"\1\2", text)
+    text = _TRAILING_WS_RE.sub("\n", text)
+    text = _BLANK_LINES_RE.sub("\n\n", text)
     return text
 
 
@@ -178,13 +191,9 @@ def format_table_rows(table_rows: List[Tuple[float, List[Tuple[int, Line]]]]) ->
 # ---------- core extraction ----------
 
 def extract_page_lines(page: fitz.Page) -> Tuple[List[Line], float]:
-    # Some PDFs have empty span.text in "rawdict"; fall back to "dict"
-    rd = page.get_text("rawdict")
-    if not any(s.get("text","").strip()
-               for b in rd.get("blocks", [])
-               for l in b.get("lines", [])
-               for s in l.get("spans", [])):
-        rd = page.get_text("dict")
+    # "rawdict" spans carry per-character "chars" and never a "text" key, so
+    # "dict" is the text model we actually read; parse the page only once
+    rd = page.get_text("dict")
 
     lines: List[Line] = []
     for b in rd.get("blocks", []):
@@ -202,12 +211,28 @@ def extract_page_lines(page: fitz.Page) -> Tuple[List[Line], float]:
             lines.append((x0, y_mid, x1, txt, fs))
     return lines, float(page.rect.height)
 
+def _extract_lines_worker(pdf_path: str, page_range: range) -> List[List[Line]]:
+    # Each worker opens its own handle; fitz documents can't be pickled
+    with fitz.open(pdf_path) as doc:
+        return [extract_page_lines(doc.load_page(i))[0] for i in page_range]
+
+def extract_pages_lines(pdf_path: str, num_pages: int, workers: int) -> List[List[Line]]:
+    """
+    Run extract_page_lines over every page, split into contiguous page ranges
+    across `workers` processes so each one opens the PDF only once.
+    """
+    step = -(-num_pages // workers)
+    ranges = [range(start, min(start + step, num_pages)) for start in range(0, num_pages, step)]
+    # spawn, not fork: the caller may be a threaded server process
+    with ProcessPoolExecutor(max_workers=len(ranges), mp_context=multiprocessing.get_context("spawn")) as ex:
+        return [lines for chunk in ex.map(partial(_extract_lines_worker, pdf_path), ranges) for lines in chunk]
+
+_DIGITS_RE = re.compile(r'\d+')
+
 def normalize_for_boiler(s: str) -> str:
     # Lowercase, strip numbers/dates, collapse spaces
-    s = s.lower()
-    s = re.sub(r'\d+', '', s)          # remove all digits
-    s = re.sub(r'\s+', ' ', s).strip()
-    return s
+    s = _DIGITS_RE.sub('', s.lower())  # remove all digits
+    return " ".join(s.split())
 
 def build_boilerplate_mask(
     pages_lines: List[List[Line]],
@@ -242,22 +267,21 @@ def order_by_columns(lines: List[Line]) -> List[Line]:
         return sorted(lines, key=lambda t: (t[1], t[0]))
 
     # Build coarse histogram of x midpoints
-    mids = [ (ln[0] + ln[2]) / 2.0 for ln in lines ]
-    buckets = Counter(int(round(x/40.0)) for x in mids)  # 40px buckets
+    keys = [ int(round(((ln[0] + ln[2]) / 2.0)/40.0)) for ln in lines ]  # 40px buckets
+    buckets = Counter(keys)
     peaks = [k for k,_ in buckets.most_common(3)]
     peaks.sort()
 
-    def assign_peak(xmid: float) -> int:
-        if not peaks:
-            return 0
-        key = int(round(xmid/40.0))
-        # nearest peak index
-        return min(range(len(peaks)), key=lambda i: abs(key - peaks[i]))
+    # A page has only a handful of distinct buckets, so resolve each bucket's
+    # nearest peak index once instead of once per line
+    nearest = {
+        key: min(range(len(peaks)), key=lambda i: abs(key - peaks[i])) if peaks else 0
+        for key in buckets
+    }
 
     cols = {i: [] for i in range(len(peaks) or 1)}
-    for x0, y, x1, txt, fs in lines:
-        idx = assign_peak((x0 + x1) / 2.0)
-        cols[idx].append((x0, y, x1, txt, fs))
+    for ln, key in zip(lines, keys):
+        cols[nearest[key]].append(ln)
 
     ordered: List[Line] = []
     for i in sorted(cols.keys()):
@@ -284,7 +308,9 @@ def lines_to_paragraphs(ordered: List[Line], y_gap: float = 16.0) -> List[str]:
 
 # ---------- optional layout assist (pdftotext -layout) ----------
 
+@lru_cache(maxsize=None)
 def has_pdftotext() -> bool:
+    # PATH lookup stats every directory; it's checked per page, so do it once
     return shutil.which("pdftotext") is not None
 
 def pdftotext_layout_page(pdf_path: str, page_index: int) -> str:
@@ -294,19 +320,16 @@ def pdftotext_layout_page(pdf_path: str, page_index: int) -> str:
     """
     if not has_pdftotext():
         return ""
-    tmp_out = os.path.splitext(pdf_path)[0] + f".p{page_index+1}.layout.txt"
+    # Write to stdout ("-") so concurrent readers of the same PDF never share
+    # a temp file next to it.
     try:
-        subprocess.run(
-            ["pdftotext", "-layout", "-f", str(page_index+1), "-l", str(page_index+1), pdf_path, tmp_out],
-            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        result = subprocess.run(
+            ["pdftotext", "-layout", "-f", str(page_index+1), "-l", str(page_index+1), pdf_path, "-"],
+            check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
         )
-        with open(tmp_out, "r", encoding="utf-8", errors="ignore") as f:
-            return f.read().strip()
+        return result.stdout.decode("utf-8", errors="ignore").strip()
     except Exception:
         return ""
-    finally:
-        try: os.remove(tmp_out)
-        except Exception: pass
 
 def looks_tabular_or_dense(lines: List[Line]) -> bool:
     # Many distinct x positions -> likely columns/tables
@@ -327,14 +350,20 @@ def extract_document(
     header_threshold: float = 0.85,
     band_px: int = 20,
     use_layout_where_helpful: bool = True,
+    workers: int = 1,
 ) -> str:
     doc = fitz.open(pdf_path)
     num_pages = len(doc)
 
-    pages_lines: List[List[Line]] = []
-    for i in range(num_pages):
-        ls, _ = extract_page_lines(doc.load_page(i))
-        pages_lines.append(ls)
+    # The server already runs one document per pool worker, so page-level
+    # parallelism is opt-in (CLI --workers) for large single documents.
+    if workers > 1 and num_pages >= 2 * workers:
+        pages_lines = extract_pages_lines(pdf_path, num_pages, workers)
+    else:
+        pages_lines: List[List[Line]] = []
+        for i in range(num_pages):
+            ls, _ = extract_page_lines(doc.load_page(i))
+            pages_lines.append(ls)
 
     boiler = build_boilerplate_mask(pages_lines, threshold=header_threshold, band_px=band_px)
 
@@ -399,6 +428,7 @@ def extract_document(
     text = normalize(text)
     return text.strip()
 
+
 # ---------- CLI ----------
 
 def main():
@@ -411,6 +441,8 @@ def main():
                     help="Y-band size in pixels for header/footer recurrence (default: 20)")
     ap.add_argument("--no-layout", action="store_true",
                     help="Disable pdftotext -layout even on table/column-dense pages")
+    ap.add_argument("--workers", type=int, default=1,
+                    help="Processes for the per-page line extraction pass (default: 1)")
     args = ap.parse_args()
 
     if not os.path.exists(args.pdf):
@@ -422,6 +454,7 @@ def main():
         header_threshold=args.header_threshold,
         band_px=args.band_px,
         use_layout_where_helpful=not args.no_layout,
+        workers=args.workers,
     )
 
     if args.out:
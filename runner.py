@@ -1,18 +1,24 @@
 # Requirements:
 # pip install openai voyageai astrapy python-dotenv
 
+import contextlib
 import os
 import sys
 import re
 import json
+import hashlib
+import math
 import uuid
 import time
-from typing import List, Dict, Any
+import threading
+from typing import List, Dict, Any, Optional, Tuple
+from array import array
 from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from openai import OpenAI
 import voyageai
 from astrapy import DataAPIClient
+from cache import prune_cache
 
 # Load environment variables
 load_dotenv()
@@ -23,6 +29,9 @@ BATCH_SIZE_INSERTS = 1000
 ANN_K = 12  # Reduced from 20 for faster search
 TOP_M_FOR_LLM = 3  # Reduced from 5 for fewer API calls
 DIM = 1024
+MAX_QUESTION_WORKERS = int(os.getenv("MAX_QUESTION_WORKERS", "8"))  # Concurrent search + LLM calls
+QUESTION_EMBEDDING_CACHE_SIZE = int(os.getenv("QUESTION_EMBEDDING_CACHE_SIZE", "1024"))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))  # Cosine similarity for reusing an answer
 
 # Configuration from environment
 OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
@@ -33,11 +42,26 @@ ASTRA_DB_APPLICATION_TOKEN = os.environ["ASTRA_DB_APPLICATION_TOKEN"]
 ASTRA_KEYSPACE = os.getenv("ASTRA_KEYSPACE", "default_keyspace")
 ASTRA_COLLECTION = os.getenv("ASTRA_COLLECTION", "rag_chunks")
 OPENAI_LLM_MODEL = os.getenv("OPENAI_LLM_MODEL", "gpt-4.1-nano-2025-04-14")
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# Chunk embeddings are cached on disk keyed by the chunk texts, so a document
+# that was already embedded skips the embedding API on later requests.
+EMBEDDING_CACHE_DIR = os.getenv(
+    "EMBEDDING_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "embedding_cache"),
+)
+# Trimmed back to this many bytes, least recently used first, after each new entry
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", str(1 << 30)))
 
 # Initialize clients
 openai_client = OpenAI(api_key=OPENAI_API_KEY)
 voyage_client = voyageai.Client(api_key=VOYAGE_API_KEY)
 
+# Question text -> embedding, shared by every run in this process so a
+# repeated question skips the embedding API
+_question_embeddings: Dict[str, List[float]] = {}
+_question_embeddings_lock = threading.Lock()
+
 # Sample questions (hardcoded for now)
 QUESTIONS = [
     "How is an accident defined in this policy?",
@@ -83,10 +107,10 @@ def parse_chunks(file_path: str) -> List[Dict[str, Any]]:
             content = f.read()
     except FileNotFoundError:
         print(f"Error: File not found: {file_path}")
-        sys.exit(1)
+        raise
     except Exception as e:
         print(f"Error reading file: {e}")
-        sys.exit(1)
+        raise
     
     content = normalize_text(content)
     
@@ -135,7 +159,7 @@ def get_embeddings_batch(texts: List[str]) -> List[List[float]]:
     """
     try:
         response = openai_client.embeddings.create(
-            model="text-embedding-3-small",
+            model=EMBEDDING_MODEL,
             input=texts,
             dimensions=DIM  # Must match the AstraDB collection dimension (1024)
         )
@@ -166,27 +190,104 @@ def embed_chunks(chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     
     return chunks
 
+def embedding_cache_path(chunks: List[Dict[str, Any]]) -> str:
+    """Cache file for a chunk list, keyed by model, dimension and chunk texts."""
+    hasher = hashlib.sha256(f"{EMBEDDING_MODEL}:{DIM}".encode("utf-8"))
+    for chunk in chunks:
+        hasher.update(b"\0")
+        hasher.update(chunk["text_full"].encode("utf-8"))
+    return os.path.join(EMBEDDING_CACHE_DIR, f"{hasher.hexdigest()}.f32")
+
+def embed_chunks_cached(chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Embed chunks, reusing vectors cached from an earlier run on the same text.
+
+    Vectors are cached as one packed float32 matrix (4 bytes per value, about
+    a fifth of the JSON size) and read back with a single frombytes call.
+    """
+    cache_path = embedding_cache_path(chunks)
+    matrix = array('f')
+    try:
+        with open(cache_path, 'rb') as f:
+            matrix.frombytes(f.read())
+    except (FileNotFoundError, ValueError):
+        matrix = None
+
+    if matrix is not None and len(matrix) == len(chunks) * DIM:
+        print(f"Using cached embeddings {cache_path}")
+        try:
+            # Bumping mtime marks the entry as recently used for prune_cache
+            os.utime(cache_path)
+        except FileNotFoundError:
+            pass
+        for i, chunk in enumerate(chunks):
+            chunk["$vector"] = matrix[i * DIM:(i + 1) * DIM].tolist()
+        return chunks
+
+    chunks = embed_chunks(chunks)
+
+    matrix = array('f')
+    for chunk in chunks:
+        matrix.extend(chunk["$vector"])
+
+    # Write to a unique part file and rename, so concurrent runs never see a partial cache
+    os.makedirs(EMBEDDING_CACHE_DIR, exist_ok=True)
+    partial_path = f"{cache_path}.{uuid.uuid4().hex}.part"
+    with open(partial_path, 'wb') as f:
+        matrix.tofile(f)
+    os.replace(partial_path, cache_path)
+    prune_cache(EMBEDDING_CACHE_DIR, EMBEDDING_CACHE_MAX_BYTES)
+    return chunks
+
 def batch_embed_questions(questions: List[str]) -> List[List[float]]:
-    """Embed all questions at once for efficiency."""
-    print(f"Batch embedding {len(questions)} questions...")
+    """Embed all questions at once for efficiency, reusing vectors for repeated questions."""
+    embeddings = {question: _question_embeddings.get(question) for question in questions}
+    missing = [question for question, embedding in embeddings.items() if embedding is None]
+    print(f"Batch embedding {len(missing)} questions ({len(embeddings) - len(missing)} cached)...")
     start_time = time.time()
     
-    embeddings = get_embeddings_batch(questions)
+    if missing:
+        fetched = dict(zip(missing, get_embeddings_batch(missing)))
+        embeddings.update(fetched)
+        with _question_embeddings_lock:
+            _question_embeddings.update(fetched)
+            # Dicts keep insertion order, so the oldest entries are dropped first
+            while len(_question_embeddings) > QUESTION_EMBEDDING_CACHE_SIZE:
+                del _question_embeddings[next(iter(_question_embeddings))]
     
     embedding_time = time.time() - start_time
     print(f"Question embeddings completed in {embedding_time:.2f} seconds")
     
-    return embeddings
+    return [embeddings[question] for question in questions]
+
+def cosine_similarity(a: List[float], b: List[float]) -> float:
+    """Cosine similarity of two vectors."""
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+def find_similar_answer(answered: List[Tuple[List[float], str]], question_embedding: List[float],
+                        threshold: float = SEMANTIC_CACHE_THRESHOLD) -> Optional[str]:
+    """Return the answer of the most similar earlier question, if it clears the threshold."""
+    best_score, best_answer = threshold, None
+    for embedding, answer in answered:
+        score = cosine_similarity(embedding, question_embedding)
+        if score >= best_score:
+            best_score, best_answer = score, answer
+    return best_answer
+
+def get_astra_collection():
+    """Return the Astra collection that holds request chunks."""
+    endpoint = f"https://{ASTRA_DB_ID}-{ASTRA_DB_REGION}.apps.astra.datastax.com"
+    client = DataAPIClient(ASTRA_DB_APPLICATION_TOKEN)
+    db = client.get_database_by_api_endpoint(endpoint, token=ASTRA_DB_APPLICATION_TOKEN, keyspace=ASTRA_KEYSPACE)
+    return db.get_collection(ASTRA_COLLECTION)
 
 def store_chunks_in_astra(chunks: List[Dict[str, Any]], request_id: str):
     """Store chunks in Astra DB with batched inserts."""
     print(f"Storing {len(chunks)} chunks in Astra DB...")
     
     # Setup Astra connection
-    endpoint = f"https://{ASTRA_DB_ID}-{ASTRA_DB_REGION}.apps.astra.datastax.com"
-    client = DataAPIClient(ASTRA_DB_APPLICATION_TOKEN)
-    db = client.get_database_by_api_endpoint(endpoint, token=ASTRA_DB_APPLICATION_TOKEN, keyspace=ASTRA_KEYSPACE)
-    collection = db.get_collection(ASTRA_COLLECTION)
+    collection = get_astra_collection()
     
     # Add request_id to all chunks
     for chunk in chunks:
@@ -289,22 +390,21 @@ def search_and_rerank(question: str, question_embedding: List[float], collection
     # Retrieve neighbor chunks from Astra
     final_chunks = list(top_results)  # Start with reranked results
     
-    if neighbor_chunks:
-        print(f"   Fetching {len(neighbor_chunks)} neighbor chunks: {sorted(neighbor_chunks)}")
+    # Skip neighbors we already have, then fetch the rest in a single query
+    have_indices = {doc["meta"]["chunk_index"] for doc in final_chunks}
+    missing_indices = sorted(neighbor_chunks - have_indices)
+    
+    if missing_indices:
+        print(f"   Fetching {len(missing_indices)} neighbor chunks: {missing_indices}")
         
-        for neighbor_index in neighbor_chunks:
-            # Check if we already have this chunk
-            if not any(doc["meta"]["chunk_index"] == neighbor_index for doc in final_chunks):
-                neighbor_results = collection.find(
-                    filter={
-                        "request_id": request_id,
-                        "meta.chunk_index": neighbor_index
-                    },
-                    limit=1
-                )
-                neighbor_list = list(neighbor_results)
-                if neighbor_list:
-                    final_chunks.append(neighbor_list[0])
+        neighbor_results = collection.find(
+            filter={
+                "request_id": request_id,
+                "meta.chunk_index": {"$in": missing_indices}
+            },
+            limit=len(missing_indices)
+        )
+        final_chunks.extend(neighbor_results)
     
     # Sort by chunk_index for coherent context
     final_chunks.sort(key=lambda x: x["meta"]["chunk_index"])
@@ -429,10 +529,107 @@ def process_single_question(question_idx: int, question: str, question_embedding
         print(f"   {error_msg}")
         return error_msg
 
-def main():
-    import sys
-    import json
+def build_index(file_path: str) -> List[Dict[str, Any]]:
+    """Parse and embed a chunked document once, for reuse across run_queries calls."""
+    print(f"Input file: {file_path}")
+    
+    # Step 1: Parse chunks
+    chunks = parse_chunks(file_path)
+    if not chunks:
+        raise ValueError("No chunks found in file")
+    
+    # Step 2: Embed chunks
+    return embed_chunks_cached(chunks)
+
+def store_index(chunks_with_embeddings: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Store chunks from build_index in Astra under a new request_id.
+
+    The returned index can answer any number of answer_questions calls and
+    must be passed to release_index once it is no longer needed.
+    """
+    request_id = str(uuid.uuid4())
+    print(f"Storing index (request_id: {request_id})")
+    try:
+        # Copies, since storing tags each chunk with request_id
+        collection = store_chunks_in_astra([dict(chunk) for chunk in chunks_with_embeddings], request_id)
+    except Exception:
+        # A failed batch may have left earlier batches behind
+        try:
+            cleanup_request_data(get_astra_collection(), request_id)
+        except:
+            pass
+        raise
+    return {"request_id": request_id, "collection": collection, "total_chunks": len(chunks_with_embeddings)}
+
+def release_index(index: Dict[str, Any]):
+    """Remove an index created by store_index from Astra."""
+    cleanup_request_data(index["collection"], index["request_id"])
+
+def answer_questions(index: Dict[str, Any], user_questions: List[str]) -> Dict[str, Any]:
+    """Answer questions against an index from store_index and return questions and answers."""
+    # Batch embed all questions
+    question_embeddings = batch_embed_questions(user_questions)
+    
+    # Process questions in parallel
+    print(f"\nProcessing {len(user_questions)} questions in parallel...")
+    parallel_start = time.time()
+    
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_QUESTION_WORKERS, len(user_questions)))) as executor:
+        # Submit all questions for parallel processing
+        futures = [
+            executor.submit(
+                process_single_question, 
+                i, question, question_embeddings[i], 
+                index["collection"], index["request_id"], index["total_chunks"]
+            )
+            for i, question in enumerate(user_questions)
+        ]
+        
+        # Collect results in order
+        answers = [future.result() for future in futures]
+    
+    parallel_time = time.time() - parallel_start
+    print(f"\nParallel processing completed in {parallel_time:.2f} seconds")
+    
+    return {
+        "questions": user_questions,
+        "answers": answers
+    }
+
+def run_queries(chunks_with_embeddings: List[Dict[str, Any]], user_questions: List[str]) -> Dict[str, Any]:
+    """Answer questions against chunks from build_index and return questions and answers.
+
+    The chunks are stored in Astra for this call only and removed afterwards,
+    including on failure.
+    """
+    print("Starting RAG pipeline")
+    print(f"LLM Model: {OPENAI_LLM_MODEL}")
+    print(f"ANN_K: {ANN_K}, TOP_M_FOR_LLM: {TOP_M_FOR_LLM}")
+    print("-" * 80)
+    
+    start_total = time.time()
+    
+    index = store_index(chunks_with_embeddings)
+    try:
+        print("-" * 80)
+        results = answer_questions(index, user_questions)
+    except Exception as e:
+        print(f"Pipeline failed: {e}")
+        raise
+    finally:
+        print("\n" + "-" * 80)
+        release_index(index)
+    
+    total_time = time.time() - start_total
+    print(f"Pipeline completed in {total_time:.2f} seconds")
+    
+    return results
 
+def run(file_path: str, user_questions: List[str]) -> Dict[str, Any]:
+    """Answer questions against a chunked document and return questions and answers."""
+    return run_queries(build_index(file_path), user_questions)
+
+def main():
     # CLI usage: python runner.py chunked.txt [questions.json]
     if len(sys.argv) < 2:
         print("Usage: python runner.py /path/to/chunked.txt [optional: questions.json]")
@@ -446,89 +643,20 @@ def main():
     else:
         user_questions = QUESTIONS
 
-    request_id = str(uuid.uuid4())
-    
-    print(f"Starting RAG pipeline (request_id: {request_id})")
-    print(f"Input file: {file_path}")
-    print(f"LLM Model: {OPENAI_LLM_MODEL}")
-    print(f"ANN_K: {ANN_K}, TOP_M_FOR_LLM: {TOP_M_FOR_LLM}")
-    print("-" * 80)
-    
-    start_total = time.time()
-    
+    # Progress logs go to stderr so stdout carries only the results JSON,
+    # which callers can hand straight to json.loads
     try:
-        # Step 1: Parse chunks
-        chunks = parse_chunks(file_path)
-        if not chunks:
-            print("No chunks found in file")
-            sys.exit(1)
-        
-        total_chunks = len(chunks)
-        
-        # Step 2: Embed chunks
-        chunks_with_embeddings = embed_chunks(chunks)
-        
-        # Step 3: Store in Astra
-        collection = store_chunks_in_astra(chunks_with_embeddings, request_id)
-        
-        print("-" * 80)
-        
-        # Step 4: Batch embed all questions
-        question_embeddings = batch_embed_questions(user_questions)
-        
-        # Step 5: Process questions in parallel
-        print(f"\nProcessing {len(user_questions)} questions in parallel...")
-        parallel_start = time.time()
-        
-        answers = []
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            # Submit all questions for parallel processing
-            futures = [
-                executor.submit(
-                    process_single_question, 
-                    i, question, question_embeddings[i], 
-                    collection, request_id, total_chunks
-                )
-                for i, question in enumerate(user_questions)
-            ]
-            
-            # Collect results in order
-            answers = [future.result() for future in futures]
-        
-        parallel_time = time.time() - parallel_start
-        print(f"\nParallel processing completed in {parallel_time:.2f} seconds")
-        
-        # Step 6: Output results
-        print("\n" + "=" * 80)
-        print("FINAL RESULTS")
-        print("=" * 80)
-        
-        results = {
-            "questions": user_questions,
-            "answers": answers
-        }
-        
-        print(json.dumps(results, indent=2))
-        
-        # Step 7: Cleanup
-        print("\n" + "-" * 80)
-        cleanup_request_data(collection, request_id)
-        
-        total_time = time.time() - start_total
-        print(f"Pipeline completed in {total_time:.2f} seconds")
-        
+        with contextlib.redirect_stdout(sys.stderr):
+            results = run(file_path, user_questions)
     except Exception as e:
-        print(f"Pipeline failed: {e}")
-        # Still attempt cleanup
-        try:
-            endpoint = f"https://{ASTRA_DB_ID}-{ASTRA_DB_REGION}.apps.astra.datastax.com"
-            client = DataAPIClient(ASTRA_DB_APPLICATION_TOKEN)
-            db = client.get_database_by_api_endpoint(endpoint, token=ASTRA_DB_APPLICATION_TOKEN, keyspace=ASTRA_KEYSPACE)
-            collection = db.get_collection(ASTRA_COLLECTION)
-            cleanup_request_data(collection, request_id)
-        except:
-            pass
+        print(f"Error: {e}", file=sys.stderr)
         sys.exit(1)
+    
+    # Output results
+    print("\n" + "=" * 80, file=sys.stderr)
+    print("FINAL RESULTS", file=sys.stderr)
+    print("=" * 80, file=sys.stderr)
+    print(json.dumps(results, indent=2))
 
 if __name__ == "__main__":
     main()
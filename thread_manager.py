@@ -34,9 +34,13 @@ class ThreadMemory:
     def __init__(self):
         self.threads = {}  # thread_id -> thread_data
         self.messages = {}  # thread_id -> [messages]
+        self.messages_by_id = {}  # thread_id -> {message_id: message}
+        self.messages_by_key = {}  # thread_id -> {idempotency_key: first message with that key}
+        self.replies = {}  # thread_id -> {user message_id: first assistant reply}
         self.working_memory = {}  # thread_id -> working memory
         self.ttl_timestamps = {}  # thread_id -> last_activity_time
         self.version = {}  # thread_id -> version number
+        self.delete_callbacks = []  # called with thread_id after a thread is deleted
     
     def cleanup_expired(self):
         """Clean up expired threads based on TTL"""
@@ -62,6 +66,10 @@ class ThreadMemory:
         if thread_id in self.messages:
             del self.messages[thread_id]
         
+        self.messages_by_id.pop(thread_id, None)
+        self.messages_by_key.pop(thread_id, None)
+        self.replies.pop(thread_id, None)
+        
         if thread_id in self.working_memory:
             del self.working_memory[thread_id]
         
@@ -70,6 +78,13 @@ class ThreadMemory:
         
         if thread_id in self.version:
             del self.version[thread_id]
+        
+        # Let the app release per-thread resources it holds outside this store
+        for callback in self.delete_callbacks:
+            try:
+                callback(thread_id)
+            except Exception as e:
+                print(f"Error in thread delete callback for {thread_id}: {e}")
 
 # Global in-memory storage
 memory = ThreadMemory()
@@ -149,6 +164,9 @@ def create_thread(doc_ids: List[str], memory_budget: int = MAX_MEMORY_TOKENS,
     # Store in memory
     memory.threads[thread_id] = thread_data
     memory.messages[thread_id] = []
+    memory.messages_by_id[thread_id] = {}
+    memory.messages_by_key[thread_id] = {}
+    memory.replies[thread_id] = {}
     memory.working_memory[thread_id] = working_memory
     memory.ttl_timestamps[thread_id] = time.time()
     memory.version[thread_id] = 1
@@ -222,6 +240,13 @@ def reset_thread(thread_id: str) -> Dict[str, Any]:
     finally:
         release_thread_lock(thread_id)
 
+def get_reply_for_key(thread_id: str, idempotency_key: str) -> Optional[Dict[str, Any]]:
+    """Return the assistant reply to the user message sent with idempotency_key, if any"""
+    msg = memory.messages_by_key.get(thread_id, {}).get(idempotency_key)
+    if not msg or msg["role"] != "user":
+        return None
+    return memory.replies[thread_id].get(msg["message_id"])
+
 def add_message(thread_id: str, role: str, content: str, 
                idempotency_key: str, parent_message_id: str = None, 
                memory_version: int = None) -> Dict[str, Any]:
@@ -243,14 +268,14 @@ def add_message(thread_id: str, role: str, content: str,
         return {"error": "Thread not found"}
     
     # Check for idempotency
-    for msg in memory.messages[thread_id]:
-        if msg.get("idempotency_key") == idempotency_key:
-            # Return existing message
-            return {
-                "message_id": msg["message_id"],
-                "thread_id": thread_id,
-                "status": "already_exists"
-            }
+    msg = memory.messages_by_key[thread_id].get(idempotency_key)
+    if msg:
+        # Return existing message
+        return {
+            "message_id": msg["message_id"],
+            "thread_id": thread_id,
+            "status": "already_exists"
+        }
     
     # Check version for optimistic concurrency
     if memory_version and memory_version != memory.version[thread_id]:
@@ -262,8 +287,7 @@ def add_message(thread_id: str, role: str, content: str,
     
     # Check parent exists if specified
     if parent_message_id:
-        parent_exists = any(msg["message_id"] == parent_message_id for msg in memory.messages[thread_id])
-        if not parent_exists:
+        if parent_message_id not in memory.messages_by_id[thread_id]:
             return {"error": f"Parent message {parent_message_id} not found"}
     
     # Acquire thread lock
@@ -289,8 +313,12 @@ def add_message(thread_id: str, role: str, content: str,
             "idempotency_key": idempotency_key
         }
         
-        # Add to messages
+        # Add to messages and the lookup indexes
         memory.messages[thread_id].append(message)
+        memory.messages_by_id[thread_id][message_id] = message
+        memory.messages_by_key[thread_id].setdefault(idempotency_key, message)
+        if role == "assistant" and parent_message_id:
+            memory.replies[thread_id].setdefault(parent_message_id, message)
         
         # Update thread stats
         memory.threads[thread_id]["turns_used"] += 1
@@ -536,18 +564,14 @@ def process_message(thread_id: str, question: str, idempotency_key: str,
     # For now, this is a placeholder that will need to be integrated with your runner.py
     
     # Check idempotency - if we already have this message, return cached result
-    if thread_id in memory.messages:
-        for msg in memory.messages[thread_id]:
-            if msg.get("idempotency_key") == idempotency_key and msg["role"] == "user":
-                # Find the assistant response that followed
-                for reply in memory.messages[thread_id]:
-                    if reply.get("parent_id") == msg["message_id"] and reply["role"] == "assistant":
-                        return {
-                            "thread_id": thread_id,
-                            "message_id": reply["message_id"],
-                            "content": reply["content"],
-                            "status": "cached"
-                        }
+    reply = get_reply_for_key(thread_id, idempotency_key)
+    if reply:
+        return {
+            "thread_id": thread_id,
+            "message_id": reply["message_id"],
+            "content": reply["content"],
+            "status": "cached"
+        }
     
     # Add user message
     user_msg = add_message(
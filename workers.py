@@ -0,0 +1,62 @@
+"""
+Worker Pool for DocuSage
+Shared process pool for CPU-bound PDF extraction and chunking
+"""
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Text extraction and chunking are CPU-bound pure Python; running them in a
+# process pool keeps concurrent requests from serializing on the GIL.
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+_extract_pool = None
+_extract_pool_lock = threading.Lock()
+
+
+def get_extract_pool():
+    """Return the process-wide extraction pool, creating it on first use."""
+    global _extract_pool
+    with _extract_pool_lock:
+        if _extract_pool is None:
+            # spawn, not fork: forking a threaded server process can copy held locks
+            _extract_pool = ProcessPoolExecutor(
+                max_workers=EXTRACT_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+    return _extract_pool
+
+
+def run_extract(fn, *args):
+    """Run fn(*args) in the extraction pool and return its result.
+
+    A worker that dies (crash or OOM kill on a bad PDF) breaks the whole
+    executor, so the broken pool is dropped and the next call starts a fresh
+    one. The failing call still raises.
+    """
+    global _extract_pool
+    pool = get_extract_pool()
+    try:
+        return pool.submit(fn, *args).result()
+    except BrokenProcessPool:
+        with _extract_pool_lock:
+            # Another request may already have replaced it
+            if _extract_pool is pool:
+                _extract_pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+
+
+def shutdown_extract_pool():
+    """Stop the extraction pool's worker processes, dropping queued work."""
+    global _extract_pool
+    with _extract_pool_lock:
+        if _extract_pool is not None:
+            _extract_pool.shutdown(wait=False, cancel_futures=True)
+            _extract_pool = None